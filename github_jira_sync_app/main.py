@@ -1,13 +1,24 @@
-import hashlib
+import asyncio
+import atexit
+import base64
 import hmac
 import logging
 import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 from pathlib import Path
 from typing import Any
+from typing import Optional
 
+import orjson
 import yaml
 from dotenv import load_dotenv
-from fastapi import Body
 from fastapi import FastAPI
 from fastapi import HTTPException
 from github import Github
@@ -16,25 +27,38 @@ from github import GithubIntegration
 from jira import JIRA
 from mistletoe import Document  # type: ignore[import]
 from mistletoe.contrib.jira_renderer import JIRARenderer  # type: ignore[import]
+from requests.adapters import HTTPAdapter
 from starlette.requests import Request
 from starlette.responses import Response
-from yaml.scanner import ScannerError
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # libyaml is not available, fall back to the pure-Python loader
+    from yaml import SafeLoader  # type: ignore[assignment]
 
 jira_text_renderer = JIRARenderer()
+# renderer keeps state while rendering, requests are handled in parallel threads
+_render_lock = threading.Lock()
+# text without any of these is rendered by Jira the same way as by GitHub
+_MARKDOWN_SYNTAX = re.compile(r"[`*_#>\[\]\\|~<!\-+={}^&]|\d[.)]|^[ \t]", re.MULTILINE)
 
 load_dotenv()
 
 jira_instance_url = os.getenv("JIRA_INSTANCE", "")
 jira_username = os.getenv("JIRA_USERNAME", "")
 jira_token = os.getenv("JIRA_TOKEN", "")
+webhook_secret = os.getenv("WEBHOOK_SECRET", "").encode("utf-8")
+bot_name = os.getenv("BOT_NAME", "")
 
 assert jira_instance_url, "URL to your Jira instance must be provided via JIRA_INSTANCE env var"
 assert jira_username, "Jira username must be provided via JIRA_USERNAME env var"
 assert jira_token, "Jira API token must be provided via JIRA_TOKEN env var"
+assert webhook_secret, "GitHub App webhook secret must be provided via WEBHOOK_SECRET env var"
 
 jira_issue_description_template = """
 This issue was created from GitHub Issue {gh_issue_url}
 Issue was submitted by: {gh_issue_author}
+Sync key: {gh_sync_key}
 
 PLEASE KEEP ALL THE CONVERSATION ON GITHUB
 
@@ -49,22 +73,39 @@ The internal ticket has been created: {jira_issue_link}.
 > This message was autogenerated
 """
 
+HANDLED_EVENTS = frozenset({"issues", "issue_comment"})
+IGNORED_ACTIONS = frozenset({"deleted", "unlabeled"})
+
+_MISSING = object()
+
 
 def define_logger():
-    """Define logger to output to the file and to STDOUT."""
+    """Define logger to output to the file and to STDOUT.
+
+    Records are only enqueued by the logger, the handlers write them from
+    a background listener thread.
+    """
     log = logging.getLogger("sync-bot-server")
+    if log.handlers:
+        # module was imported twice, e.g. as __main__ and by uvicorn
+        return log
+
     log.setLevel(logging.DEBUG)
     formatter = logging.Formatter(
         fmt="%(asctime)s (%(levelname)s) %(message)s", datefmt="%d.%m.%Y %H:%M:%S"
     )
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
-    log.addHandler(stream_handler)
 
     log_file = os.environ.get("SYNC_BOT_LOGFILE", "sync_bot.log")
     file_handler = logging.FileHandler(filename=log_file)
     file_handler.setFormatter(formatter)
-    log.addHandler(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    log.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # flush remaining records on shutdown
     return log
 
 
@@ -72,9 +113,9 @@ logger = define_logger()
 
 
 with open(Path(__file__).parent / "settings.yaml") as file:
-    _file_settings = yaml.safe_load(file)
+    _file_settings = yaml.load(file, Loader=SafeLoader)
 
-_env_settings = yaml.safe_load(os.getenv("DEFAULT_BOT_CONFIG", "{}"))
+_env_settings = yaml.load(os.getenv("DEFAULT_BOT_CONFIG", "{}"), Loader=SafeLoader)
 
 DEFAULT_SETTINGS = _env_settings or _file_settings
 
@@ -87,10 +128,31 @@ git_integration = GithubIntegration(
     app_key,
 )
 
+# installation IDs rarely change, tokens are valid for ~1 hour
+_installation_ids: dict[tuple[str, str], int] = {}
+_installation_tokens: dict[tuple[str, str], tuple[str, float]] = {}
+
+_jira: Optional[JIRA] = None
+_jira_lock = threading.Lock()
+
+# project components change rarely, refresh them every few minutes
+_components_cache: dict[str, tuple[frozenset[str], float]] = {}
+
+# parsed settings of the repositories together with ETag of the settings file
+_settings_cache: dict[str, tuple[str, dict]] = {}
+
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def configure_executor():
+    """Enlarge the default executor that runs blocking GitHub and Jira calls."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=int(os.getenv("SYNC_BOT_WORKERS", "32")))
+    )
+
+
 @app.middleware("http")
 async def catch_exceptions_middleware(request, call_next):
     """Middleware to catch all exceptions.
@@ -106,17 +168,175 @@ async def catch_exceptions_middleware(request, call_next):
 
 
 def merge_dicts(d1, d2):
-    """Merge the two dictionaries (d2 into d1) recursively.
+    """Merge the two dictionaries (d2 into d1) including nested dictionaries.
 
     If the key from d2 exists in d1, then skip (do not override).
 
     Mutates d1
     """
-    for key in d2:
-        if key in d1 and isinstance(d1[key], dict) and isinstance(d2[key], dict):
-            merge_dicts(d1[key], d2[key])
-        elif key not in d1:
-            d1[key] = d2[key]
+    stack = [(d1, d2)]
+    while stack:
+        target, source = stack.pop()
+        for key, value in source.items():
+            existing = target.get(key, _MISSING)
+            if existing is _MISSING:
+                target[key] = value
+            elif isinstance(existing, dict) and isinstance(value, dict):
+                stack.append((existing, value))
+
+
+def get_jira():
+    """Get Jira client shared between all requests.
+
+    Client is created on the first call, its session keeps the connections to
+    Jira alive and is sized for the concurrent workers of the thread pool.
+    """
+    global _jira
+    with _jira_lock:
+        if _jira is None:
+            _jira = JIRA(jira_instance_url, basic_auth=(jira_username, jira_token))
+            _jira._session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+    return _jira
+
+
+def get_allowed_components(project_key, ttl=300):
+    """Get names of the components that exist in the Jira project.
+
+    Result is cached for `ttl` seconds.
+
+    Args:
+        project_key: Jira project key
+        ttl: time in seconds to keep the components in cache
+
+    Returns:
+        frozenset of component names
+    """
+    cached = _components_cache.get(project_key)
+    if cached and time.time() < cached[1]:
+        return cached[0]
+
+    components = frozenset(c.name for c in get_jira().project_components(project_key))
+    _components_cache[project_key] = (components, time.time() + ttl)
+    return components
+
+
+def get_installation_token(owner, repo_name):
+    """Get GitHub App installation access token for the repository.
+
+    Installation ID and access token are cached, the token is renewed a minute
+    before it expires. If the cached installation ID is stale (e.g. the app was
+    reinstalled), the installation is looked up again.
+
+    Args:
+        owner: owner of the repository
+        repo_name: name of the repository
+
+    Returns:
+        installation access token
+    """
+    key = (owner, repo_name)
+    cached = _installation_tokens.get(key)
+    if cached and time.time() < cached[1] - 60:
+        return cached[0]
+
+    installation_id = _installation_ids.get(key)
+    if installation_id is None:
+        installation_id = git_integration.get_repo_installation(owner, repo_name).id
+        _installation_ids[key] = installation_id
+        auth = git_integration.get_access_token(installation_id)
+    else:
+        try:
+            auth = git_integration.get_access_token(installation_id)
+        except GithubException:
+            # app was reinstalled, retry once with a fresh installation ID
+            _installation_ids.pop(key, None)
+            _installation_tokens.pop(key, None)
+            return get_installation_token(owner, repo_name)
+
+    expires_at = auth.expires_at.replace(tzinfo=timezone.utc).timestamp()
+    _installation_tokens[key] = (auth.token, expires_at)
+    return auth.token
+
+
+def get_repo_settings(repo):
+    """Get bot settings of the repository merged with the default settings.
+
+    Parsed settings are cached together with the ETag of the settings file, the
+    file is requested conditionally and parsed again only if it was modified.
+
+    Args:
+        repo: GitHub repository
+
+    Returns:
+        dictionary with the settings
+
+    Raises:
+        GithubException: if the settings file does not exist
+        yaml.YAMLError: if the settings file is not a valid YAML
+    """
+    cached = _settings_cache.get(repo.full_name)
+    request_headers = {"If-None-Match": cached[0]} if cached else None
+    headers, data = repo._requester.requestJsonAndCheck(
+        "GET", f"{repo.url}/contents/.github/.jira_sync_config.yaml", headers=request_headers
+    )
+    if cached and data is None:
+        # 304 Not Modified, GitHub returns an empty body
+        return cached[1]
+
+    settings = yaml.load(base64.b64decode(data["content"]), Loader=SafeLoader)
+    merge_dicts(settings, DEFAULT_SETTINGS)
+    settings = settings["settings"]
+
+    if "etag" in headers:
+        _settings_cache[repo.full_name] = (headers["etag"], settings)
+    return settings
+
+
+def render_markdown(text):
+    """Convert GitHub markdown to Jira wiki markup.
+
+    Plain text without markdown syntax is returned as is, without parsing.
+
+    Args:
+        text: markdown text, might be None for issues without description
+
+    Returns:
+        text in Jira wiki markup
+    """
+    if not text:
+        return ""
+
+    if not _MARKDOWN_SYNTAX.search(text):
+        return text
+
+    with _render_lock:
+        return jira_text_renderer.render(Document(text))
+
+
+def search_existing_issues(project_key, sync_key, issue_url):
+    """Search Jira for the issue that is synchronized with the GitHub issue.
+
+    Issues are looked up by the sync key from the description. Issues created
+    before the sync key was introduced are matched by the GitHub issue URL in
+    the same query.
+
+    Args:
+        project_key: Jira project key
+        sync_key: unique key of the GitHub issue, e.g. gh-sync:owner/repo#1
+        issue_url: URL of the GitHub issue
+
+    Returns:
+        list with the found Jira issue, empty if the issue does not exist
+    """
+    existing_issues = get_jira().search_issues(
+        f"project={project_key} AND "
+        f'(description ~ "\\"{sync_key}\\"" OR description ~ "\\"{issue_url}\\"")',
+        maxResults=1,
+        fields="components",
+        json_result=False,
+    )
+    assert isinstance(existing_issues, list), "Jira did not return a list of existing issues"
+    return existing_issues
 
 
 def verify_signature(payload_body, secret_token, signature_header):
@@ -126,70 +346,90 @@ def verify_signature(payload_body, secret_token, signature_header):
 
     Args:
         payload_body: original request body to verify (request.body())
-        secret_token: GitHub app webhook token (WEBHOOK_SECRET)
+        secret_token: GitHub app webhook token encoded to bytes (WEBHOOK_SECRET)
         signature_header: header received from GitHub (x-hub-signature-256)
 
     """
     if not signature_header:
         raise HTTPException(status_code=403, detail="x-hub-signature-256 header is missing!")
 
-    hash_object = hmac.new(secret_token.encode("utf-8"), msg=payload_body, digestmod=hashlib.sha256)
-    expected_signature = "sha256=" + hash_object.hexdigest()
-    if not hmac.compare_digest(expected_signature, signature_header):
+    # reject malformed headers before doing any HMAC work
+    if len(signature_header) != 71 or signature_header[:7] != "sha256=":
+        raise HTTPException(status_code=403, detail="Request signatures didn't match!")
+
+    try:
+        received_signature = bytes.fromhex(signature_header[7:])
+    except ValueError:
+        raise HTTPException(status_code=403, detail="Request signatures didn't match!")
+
+    expected_signature = hmac.digest(secret_token, payload_body, "sha256")
+    if not hmac.compare_digest(expected_signature, received_signature):
         raise HTTPException(status_code=403, detail="Request signatures didn't match!")
 
 
 @app.post("/")
-async def bot(request: Request, payload: dict = Body(...)):
+async def bot(request: Request):
+    # nothing is done for other events, skip them before hashing and parsing the body
+    if request.headers.get("x-github-event") not in HANDLED_EVENTS:
+        return {"msg": "Event is not related to issues. Ignoring."}
+
     body_ = await request.body()
     signature_ = request.headers.get("x-hub-signature-256")
 
-    verify_signature(body_, os.getenv("WEBHOOK_SECRET"), signature_)
+    verify_signature(body_, webhook_secret, signature_)
 
-    if not all(k in payload.keys() for k in ["action", "issue"]):
+    try:
+        payload = orjson.loads(body_)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Request body is not a valid JSON!")
+
+    if "action" not in payload or "issue" not in payload:
         return {"msg": "Action wasn't triggered by Issue action. Ignoring."}
 
     if "pull_request" in payload["issue"]:
         return {"msg": "Action was triggered by PR comment. Ignoring."}
 
-    if payload["sender"]["login"] == os.getenv("BOT_NAME"):
+    if payload["sender"]["login"] == bot_name:
         return {"msg": "Action was triggered by bot. Ignoring."}
 
-    if payload["action"] in ["deleted", "unlabeled"]:
+    if payload["action"] in IGNORED_ACTIONS:
         return {"msg": "Action was triggered by Issue unlabeling. Ignoring."}
 
-    if payload["action"] == "edited" and "comment" in payload.keys():
+    if payload["action"] == "edited" and "comment" in payload:
         return {"msg": "Action was triggered by comment edit. Ignoring."}
 
+    # PyGithub and Jira clients are blocking, do not hold the event loop
+    return await asyncio.to_thread(sync_issue, payload)
+
+
+def sync_issue(payload: dict) -> dict:
+    """Synchronize GitHub issue from the webhook payload to Jira.
+
+    Performs blocking requests to GitHub and Jira, must be run in a thread.
+
+    Args:
+        payload: webhook payload received from GitHub
+
+    Returns:
+        response message for GitHub
+    """
     owner = payload["repository"]["owner"]["login"]
     repo_name = payload["repository"]["name"]
 
-    git_connection = Github(
-        login_or_token=git_integration.get_access_token(
-            git_integration.get_repo_installation(owner, repo_name).id
-        ).token
-    )
+    git_connection = Github(login_or_token=get_installation_token(owner, repo_name))
     repo = git_connection.get_repo(f"{owner}/{repo_name}")
     issue = repo.get_issue(number=payload["issue"]["number"])
     try:
-        contents = repo.get_contents(".github/.jira_sync_config.yaml")
-        settings_content = contents.decoded_content  # type: ignore[union-attr]
+        settings = get_repo_settings(repo)
     except GithubException:
         msg = ".github/.jira_sync_config.yaml file was not found"
         logger.error(msg)
         return {"msg": msg}
-
-    try:
-        settings = yaml.safe_load(settings_content)
-    except ScannerError:
+    except yaml.YAMLError:
         msg = ".github/.jira_sync_config.yaml file is invalid. Check syntax."
         logger.error(msg)
         return {"msg": msg}
 
-    merge_dicts(settings, DEFAULT_SETTINGS)
-
-    settings = settings["settings"]
-
     if not settings["jira_project_key"]:
         msg = "Jira project key is not specified. Add `jira_project_key` key to the settings file."
         logger.warning(msg)
@@ -201,54 +441,55 @@ async def bot(request: Request, payload: dict = Body(...)):
         return {"msg": msg}
 
     labels = settings["labels"] or []
-    allowed_labels = [label.lower() for label in labels]
+    allowed_labels = frozenset(label.lower() for label in labels)
+    # keep the order of payload labels, first match wins in label_mapping
     payload_labels = [label["name"].lower() for label in payload["issue"]["labels"]]
-    if allowed_labels and not any(label in allowed_labels for label in payload_labels):
+    if allowed_labels and allowed_labels.isdisjoint(payload_labels):
         msg = "Issue is not labeled with the specified label"
         logger.warning(msg)
         return {"msg": msg}
 
-    jira = JIRA(jira_instance_url, basic_auth=(jira_username, jira_token))
-    existing_issues = jira.search_issues(
-        f'project={settings["jira_project_key"]} AND description ~ "{issue.html_url}"',
-        json_result=False,
-    )
-    assert isinstance(existing_issues, list), "Jira did not return a list of existing issues"
-    issue_body = issue.body if settings["sync_description"] else ""
-    if issue_body:
-        doc = Document(issue_body)
-        issue_body = jira_text_renderer.render(doc)
-
-    issue_description = jira_issue_description_template.format(
-        gh_issue_url=issue.html_url,
-        gh_issue_author=issue.user.login,
-        gh_issue_body=issue_body,
-    )
+    jira = get_jira()
+    sync_key = f"gh-sync:{owner}/{repo_name}#{issue.number}"
+    existing_issues = search_existing_issues(settings["jira_project_key"], sync_key, issue.html_url)
+
+    def build_issue_dict() -> dict[str, Any]:
+        """Build fields of the Jira issue, only needed to create or update the issue."""
+        issue_body = render_markdown(issue.body) if settings["sync_description"] else ""
 
-    issue_type = "Bug"
-    if settings["label_mapping"]:
-        for label in payload_labels:
-            if label in settings["label_mapping"]:
-                issue_type = settings["label_mapping"][label]
-                break
-
-    issue_dict: dict[str, Any] = {
-        "project": {"key": settings["jira_project_key"]},
-        "summary": issue.title,
-        "description": issue_description,
-        "issuetype": {"name": issue_type},
-    }
-    if settings["epic_key"]:
-        issue_dict["parent"] = {"key": settings["epic_key"]}
-
-    if settings["components"]:
-        allowed_components = [c.name for c in jira.project_components(settings["jira_project_key"])]
-
-        issue_dict["components"] = [
-            {"name": component}
-            for component in settings["components"]
-            if component in allowed_components
-        ]
+        issue_description = jira_issue_description_template.format(
+            gh_issue_url=issue.html_url,
+            gh_issue_author=issue.user.login,
+            gh_sync_key=sync_key,
+            gh_issue_body=issue_body,
+        )
+
+        issue_type = "Bug"
+        if settings["label_mapping"]:
+            for label in payload_labels:
+                if label in settings["label_mapping"]:
+                    issue_type = settings["label_mapping"][label]
+                    break
+
+        issue_dict: dict[str, Any] = {
+            "project": {"key": settings["jira_project_key"]},
+            "summary": issue.title,
+            "description": issue_description,
+            "issuetype": {"name": issue_type},
+        }
+        if settings["epic_key"]:
+            issue_dict["parent"] = {"key": settings["epic_key"]}
+
+        if settings["components"]:
+            allowed_components = get_allowed_components(settings["jira_project_key"])
+
+            issue_dict["components"] = [
+                {"name": component}
+                for component in settings["components"]
+                if component in allowed_components
+            ]
+
+        return issue_dict
 
     opened_status = settings["status_mapping"]["opened"]
     closed_status = settings["status_mapping"]["closed"]
@@ -257,7 +498,7 @@ async def bot(request: Request, payload: dict = Body(...)):
         if payload["action"] == "closed":
             return {"msg": "Issue in Jira doesn't exist and GitHub issue was closed. Ignoring."}
 
-        new_issue = jira.create_issue(fields=issue_dict)
+        new_issue = jira.create_issue(fields=build_issue_dict())
         existing_issues.append(new_issue)
 
         if settings["add_gh_comment"]:
@@ -271,19 +512,21 @@ async def bot(request: Request, payload: dict = Body(...)):
         elif payload["action"] == "reopened":
             jira.transition_issue(jira_issue, opened_status)
         elif payload["action"] == "edited":
+            issue_dict = build_issue_dict()
             if settings["components"]:
-                # need to append components to the existing list
+                # need to append components to the existing list, skip duplicates
+                seen = {component["name"] for component in issue_dict["components"]}
                 for component in jira_issue.fields.components:
-                    issue_dict["components"].append({"name": component.name})
+                    if component.name not in seen:
+                        issue_dict["components"].append({"name": component.name})
+                        seen.add(component.name)
 
             jira_issue.update(fields=issue_dict)
 
-    if settings["sync_comments"] and payload["action"] == "created" and "comment" in payload.keys():
+    if settings["sync_comments"] and payload["action"] == "created" and "comment" in payload:
         # new comment was added to the issue
 
-        comment_body = payload["comment"]["body"]
-        doc = Document(comment_body)
-        comment_body = jira_text_renderer.render(doc)
+        comment_body = render_markdown(payload["comment"]["body"])
         jira.add_comment(
             existing_issues[0],
             f"User *{payload['sender']['login']}* commented:\n {comment_body}",
@@ -296,4 +539,12 @@ async def bot(request: Request, payload: dict = Body(...)):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=3000)
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # uvloop and httptools are picked automatically where available (not on Windows)
+    # multiple workers require the app as import string, avoid importing the module twice otherwise
+    uvicorn.run(
+        "github_jira_sync_app.main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=3000,
+        workers=workers,
+    )
@@ -10,3 +10,16 @@ def signature_mock(request):
     with patch("github_jira_sync_app.main.verify_signature", wraps=lambda *x: None) as signature:
         yield signature
         signature.assert_called()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Reset module level caches so every test replays its recorded responses."""
+    from github_jira_sync_app import main
+
+    main._installation_ids.clear()
+    main._installation_tokens.clear()
+    main._jira = None
+    main._components_cache.clear()
+    main._settings_cache.clear()
+    yield
@@ -1,7 +1,11 @@
 import json
 import os
+import time
 from pathlib import Path
+from unittest.mock import MagicMock
+from unittest.mock import patch
 
+import pytest
 import responses
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
@@ -11,11 +15,16 @@ load_dotenv(Path(__file__).parent / "dumm_env", verbose=True)
 assert os.environ["JIRA_INSTANCE"]
 
 # import only after we set dummy environment
+from github_jira_sync_app import main  # noqa: E402
 from github_jira_sync_app.main import app  # noqa: E402
 
 client = TestClient(app)
 
 
+ISSUES_EVENT = {"x-github-event": "issues"}
+COMMENT_EVENT = {"x-github-event": "issue_comment"}
+
+
 def _get_json(file_name):
     with open(UNITTESTS_DIR / "payloads" / file_name) as file:
         return json.load(file)
@@ -26,16 +35,49 @@ def test_hash_validation():
     response = client.post(
         "/",
         json=_get_json("comment_created_by_bot.json"),
-        headers={"x-hub-signature-256": data_hash},
+        headers={"x-hub-signature-256": data_hash, **COMMENT_EVENT},
+    )
+
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "data_hash",
+    [
+        "sha256=" + "0" * 64,
+        "sha256=" + "z" * 64,
+        "sha256=" + "0" * 62,
+        "sha1=" + "0" * 40,
+    ],
+)
+def test_hash_validation_failed(data_hash):
+    response = client.post(
+        "/",
+        json=_get_json("comment_created_by_bot.json"),
+        headers={"x-hub-signature-256": data_hash, **COMMENT_EVENT},
     )
 
+    assert response.status_code == 403
+
+
+def test_not_issue_event():
+    response = client.post("/", content=b"{}", headers={"x-github-event": "push"})
+
     assert response.status_code == 200
+    assert response.json() == {"msg": "Event is not related to issues. Ignoring."}
+
+
+def test_invalid_json(signature_mock):
+    response = client.post("/", content=b"not a json", headers=ISSUES_EVENT)
+
+    assert response.status_code == 400
 
 
 def test_comment_created_by_bot(signature_mock):
     response = client.post(
         "/",
         json=_get_json("comment_created_by_bot.json"),
+        headers=COMMENT_EVENT,
     )
 
     assert response.status_code == 200
@@ -51,6 +93,7 @@ def test_comment_created_by_user(signature_mock):
     response = client.post(
         "/",
         json=_get_json("comment_created_by_user.json"),
+        headers=COMMENT_EVENT,
     )
 
     assert response.status_code == 200
@@ -65,6 +108,7 @@ def test_issue_labeled_correct(signature_mock):
     response = client.post(
         "/",
         json=_get_json("issue_labeled_correct.json"),
+        headers=ISSUES_EVENT,
     )
 
     assert response.status_code == 200
@@ -79,6 +123,7 @@ def test_issue_created_with_label(signature_mock):
     response = client.post(
         "/",
         json=_get_json("issue_created_with_label.json"),
+        headers=ISSUES_EVENT,
     )
 
     assert response.status_code == 200
@@ -92,7 +137,102 @@ def test_issue_created_without_label(signature_mock):
     response = client.post(
         "/",
         json=_get_json("issue_created_without_label.json"),
+        headers=ISSUES_EVENT,
     )
 
     assert response.status_code == 200
     assert response.json() == {"msg": "Issue is not labeled with the specified label"}
+
+
+def test_installation_token_is_cached():
+    main._installation_tokens[("owner", "repo")] = ("cached-token", time.time() + 3600)
+
+    assert main.get_installation_token("owner", "repo") == "cached-token"
+
+
+@responses.activate
+def test_installation_token_expired():
+    responses._add_from_file(UNITTESTS_DIR / "url_responses" / "auth_github_responses.yaml")
+    key = ("beliaev-maksim", "test-ci")
+    main._installation_ids[key] = 35534068
+    main._installation_tokens[key] = ("expired-token", time.time() - 1)
+
+    assert main.get_installation_token(*key) == "ghs_XVo5Hjf"
+    # installation ID is reused, only a new token is requested
+    assert [call.request.method for call in responses.calls] == ["POST"]
+
+
+@responses.activate
+def test_installation_token_reinstalled_app():
+    responses.post("https://api.github.com:443/app/installations/1/access_tokens", status=404)
+    responses._add_from_file(UNITTESTS_DIR / "url_responses" / "auth_github_responses.yaml")
+    key = ("beliaev-maksim", "test-ci")
+    main._installation_ids[key] = 1
+
+    assert main.get_installation_token(*key) == "ghs_XVo5Hjf"
+    assert main._installation_ids[key] == 35534068
+
+
+def test_merge_dicts():
+    d1 = {"settings": {"labels": ["bug"], "nested": {"a": 1}}, "other": None}
+    d2 = {"settings": {"labels": None, "epic_key": None, "nested": {"a": 2, "b": 3}}, "other": {}}
+    main.merge_dicts(d1, d2)
+
+    assert d1 == {
+        "settings": {"labels": ["bug"], "epic_key": None, "nested": {"a": 1, "b": 3}},
+        "other": None,
+    }
+
+
+def test_search_existing_issues():
+    """Issues created before the sync key was added are found by the GitHub URL."""
+    with patch("github_jira_sync_app.main.get_jira") as jira_mock:
+        jira_mock.return_value.search_issues.return_value = ["MTC-1"]
+        existing_issues = main.search_existing_issues(
+            "MTC", "gh-sync:owner/repo#1", "https://github.com/owner/repo/issues/1"
+        )
+
+    assert existing_issues == ["MTC-1"]
+    jira_mock.return_value.search_issues.assert_called_once()
+    jql = jira_mock.return_value.search_issues.call_args.args[0]
+    assert jql == (
+        'project=MTC AND (description ~ "\\"gh-sync:owner/repo#1\\"" '
+        'OR description ~ "\\"https://github.com/owner/repo/issues/1\\"")'
+    )
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        (None, ""),
+        ("", ""),
+        ("plain text, nothing to render.", "plain text, nothing to render."),
+        ("**bold** text", "*bold* text\n\n"),
+        ("1. item", "# item\n\n"),
+        ("see a-b", "see a\\-b\n\n"),
+    ],
+)
+def test_render_markdown(text, expected):
+    assert main.render_markdown(text) == expected
+
+
+def test_repo_settings_not_modified():
+    settings = {"jira_project_key": "MTC"}
+    main._settings_cache["owner/repo"] = ('"etag"', settings)
+    repo = MagicMock(full_name="owner/repo", url="https://api.github.com/repos/owner/repo")
+    repo._requester.requestJsonAndCheck.return_value = ({}, None)
+
+    assert main.get_repo_settings(repo) is settings
+    request_headers = repo._requester.requestJsonAndCheck.call_args.kwargs["headers"]
+    assert request_headers == {"If-None-Match": '"etag"'}
+
+
+@responses.activate
+def test_allowed_components_are_cached():
+    responses._add_from_file(UNITTESTS_DIR / "url_responses" / "jira_auth_responses.yaml")
+    responses._add_from_file(UNITTESTS_DIR / "url_responses" / "jira_components_responses.yaml")
+
+    components = main.get_allowed_components("MTC")
+    assert "DACH TT" in components
+    assert main.get_allowed_components("MTC") is components
+    assert len(responses.calls) == 2  # serverInfo and components, second call is cached